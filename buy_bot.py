@@ -1,9 +1,16 @@
 
 import os
-import requests
+import asyncio
+import diskcache
+import heapq
+import httpx
+import msgspec
+import random
 import datetime
 import logging
+import time
 from telegram import Update
+from telegram.helpers import escape_markdown
 from telegram.ext import Application, CommandHandler, ContextTypes, MessageHandler, filters
 
 # Configuration
@@ -11,6 +18,10 @@ BOT_TOKEN = os.environ.get("BOT_TOKEN", "")
 CHAT_ID = int(os.environ.get("CHAT_ID", "0"))
 if not BOT_TOKEN or CHAT_ID == 0:
     raise ValueError("BOT_TOKEN and CHAT_ID must be set in environment variables")
+# Public base URL (e.g. https://mybot.example.com); when set, Telegram pushes
+# updates to us via webhook instead of the bot long-polling getUpdates
+WEBHOOK_URL = os.environ.get("WEBHOOK_URL", "").rstrip("/")
+PORT = int(os.environ.get("PORT", "8443"))
 
 # Supported currencies for HSBC UK
 HSBC_SUPPORTED_CURRENCIES = [
@@ -20,11 +31,18 @@ HSBC_SUPPORTED_CURRENCIES = [
 ]
 
 # Allowed payment methods
-ALLOWED_PAYMENT_METHODS = {
+ALLOWED_PAYMENT_METHODS = frozenset({
     "Bank Transfer",
     "Faster Payment",
     "Instant Transfer"
-}
+})
+ALLOWED_PAYMENT_STR = ", ".join(sorted(ALLOWED_PAYMENT_METHODS))
+
+# Rank markers for the top three offers
+MEDALS = ("🥇", "🥈", "🥉")
+
+# On-disk cache for FX tables and bot state, so restarts don't start cold
+CACHE = diskcache.Cache(os.environ.get("CACHE_DIR", ".cache"))
 
 # State management
 state = {
@@ -33,6 +51,13 @@ state = {
     "last_results": [],
     "last_usdt_price": None
 }
+state.update(CACHE.get("state", {}))
+
+# diskcache is synchronous SQLite; writes run in a worker thread so a slow
+# disk can't stall every other update. A shallow copy is handed over, since
+# handlers replace (not mutate) the values while the write is in progress.
+async def save_state():
+    await asyncio.to_thread(CACHE.set, "state", dict(state))
 
 logging.basicConfig(
     format="%(asctime)s - %(levelname)s - %(message)s",
@@ -40,136 +65,252 @@ logging.basicConfig(
 )
 logger = logging.getLogger(__name__)
 
+# Binance P2P search endpoint and the request fields that never change
+P2P_URL = "https://p2p.binance.com/bapi/c2c/v2/friendly/c2c/adv/search"
+P2P_PAYLOAD_TEMPLATE = {
+    "page": 1,
+    "rows": 20,
+    "tradeType": "BUY",  # Changed to BUY instead of SELL
+    "asset": "USDT",
+    "countries": [],
+    "proMerchantAds": False,
+    "shieldMerchantAds": False,
+    "filterType": "all",
+    "periods": [],
+    "additionalKycVerifyFilter": 0,
+    "publisherType": None,
+    "payTypes": [],
+    "classifies": ["mass", "profession", "fiat_trade"],
+}
+JSON_HEADERS = {"Content-Type": "application/json"}
+# The template encoded once, minus its closing brace; each search only
+# appends its own fiat and amount
+P2P_BODY_PREFIX = msgspec.json.encode(P2P_PAYLOAD_TEMPLATE)[:-1]
+
+def p2p_body(currency, usdt_amount):
+    return b'%s,"fiat":%s,"transAmount":%s}' % (
+        P2P_BODY_PREFIX, msgspec.json.encode(currency), msgspec.json.encode(usdt_amount)
+    )
+
+# Transient P2P failures are retried. There is no separate concurrency cap:
+# cached_p2p's per-key locks already allow one search per currency, so a
+# fetch's batch (at most 18 searches) goes out in a single wave
+P2P_RETRIES = 2
+RETRY_STATUSES = frozenset({429, 500, 502, 503, 504})
+
+# Typed view of the P2P search response. Only the fields we read are
+# declared; the rest of each ad is skipped while decoding. Binance sends
+# amounts as strings, so decode in lax mode to get floats directly.
+class TradeMethod(msgspec.Struct):
+    tradeMethodName: str | None = None
+
+class Adv(msgspec.Struct):
+    price: float
+    minSingleTransAmount: float
+    dynamicMaxSingleTransAmount: float
+    surplusAmount: float
+    tradeMethods: list[TradeMethod] = []
+
+class Advertiser(msgspec.Struct):
+    nickName: str
+    monthFinishRate: float = 0.0
+    monthOrderCount: int = 0
+
+class Ad(msgspec.Struct):
+    adv: Adv
+    advertiser: Advertiser
+
+class SearchResponse(msgspec.Struct):
+    data: list[Ad] | None = None
+
+P2P_DECODER = msgspec.json.Decoder(SearchResponse, strict=False)
+
+# exchangerate-api response; everything besides the rates table is skipped
+class RatesResponse(msgspec.Struct):
+    rates: dict[str, float]
+
+FX_DECODER = msgspec.json.Decoder(RatesResponse)
+
+# Static headers Binance expects on every P2P request
+BINANCE_HEADERS = {
+    "Accept": "*/*",
+    "Origin": "https://p2p.binance.com",
+    "Referer": "https://p2p.binance.com/en/trade/buy/USDT",
+    "User-Agent": "Mozilla/5.0 (Windows NT 10.0; Win64; x64)",
+}
+
+# Shared async client for Binance and FX calls, opened on the bot's event
+# loop in post_init
+HTTP = None
+
+async def open_http(app):
+    global HTTP
+    HTTP = httpx.AsyncClient(
+        transport=httpx.AsyncHTTPTransport(
+            http2=True,  # the concurrent P2P searches multiplex over one connection
+            # no transport retries: post_p2p owns retrying Binance searches,
+            # and a failed FX request isn't cached, so the next fetch retries it
+            limits=httpx.Limits(max_connections=32, max_keepalive_connections=32, keepalive_expiry=60),
+        ),
+        headers=BINANCE_HEADERS,
+        timeout=httpx.Timeout(15, connect=3),
+    )
+
+async def close_http(app):
+    if HTTP is not None:
+        await HTTP.aclose()
+
 # Exchange rate API
-def get_exchange_rate(from_currency, to_currency="EGP"):
+# Each response carries every rate for its base, so cache whole tables by base
+FX_CACHE_TTL = 300  # seconds
+
+async def get_rates_table(base):
+    key = f"fx:{base}"
+    rates = await asyncio.to_thread(CACHE.get, key)
+    if rates is not None:
+        return rates
     try:
-        url = f"https://api.exchangerate-api.com/v4/latest/{from_currency}"
-        r = requests.get(url, timeout=5)
-        data = r.json()
-        if to_currency in data["rates"]:
-            return data["rates"][to_currency]
+        url = f"https://api.exchangerate-api.com/v4/latest/{base}"
+        r = await HTTP.get(url, timeout=5)
+        rates = FX_DECODER.decode(r.content).rates
     except Exception:
-        pass
-    return None
+        return None
+    await asyncio.to_thread(CACHE.set, key, rates, expire=FX_CACHE_TTL)
+    return rates
+
+# POST a search, retrying timeouts, dropped connections and 429/5xx with
+# exponential backoff plus jitter, so searches that failed together don't
+# all retry in lockstep
+async def post_p2p(body):
+    for attempt in range(P2P_RETRIES + 1):
+        try:
+            resp = await HTTP.post(P2P_URL, content=body, headers=JSON_HEADERS)
+            if resp.status_code not in RETRY_STATUSES or attempt == P2P_RETRIES:
+                return resp
+        except (httpx.TimeoutException, httpx.NetworkError):
+            if attempt == P2P_RETRIES:
+                raise
+        await asyncio.sleep(0.2 * 2 ** attempt + random.random() * 0.1)
 
 # Get best buy price for currency
-def get_p2p_buy_price_for_currency(currency, usdt_amount):
-    url = "https://p2p.binance.com/bapi/c2c/v2/friendly/c2c/adv/search"
-    payload = {
-        "fiat": currency,
-        "page": 1,
-        "rows": 20,
-        "tradeType": "BUY",  # Changed to BUY instead of SELL
-        "asset": "USDT",
-        "countries": [],
-        "proMerchantAds": False,
-        "shieldMerchantAds": False,
-        "filterType": "all",
-        "periods": [],
-        "additionalKycVerifyFilter": 0,
-        "publisherType": None,
-        "payTypes": [],
-        "classifies": ["mass", "profession", "fiat_trade"],
-        "transAmount": usdt_amount,
-    }
-    headers = {
-        "Accept": "*/*",
-        "Content-Type": "application/json",
-        "Origin": "https://p2p.binance.com",
-        "Referer": "https://p2p.binance.com/en/trade/buy/USDT",
-        "User-Agent": "Mozilla/5.0 (Windows NT 10.0; Win64; x64)",
-    }
+async def get_p2p_buy_price_for_currency(currency, usdt_amount):
+    body = p2p_body(currency, usdt_amount)
 
     try:
-        resp = requests.post(url, json=payload, headers=headers, timeout=15)
+        resp = await post_p2p(body)
         if resp.status_code != 200:
             return {"currency": currency, "success": False, "error": f"HTTP {resp.status_code}"}
 
-        data = resp.json()
-        ads = data.get("data") or []
+        ads = P2P_DECODER.decode(resp.content).data or []
         if not ads:
             return {"currency": currency, "success": False, "error": "No ads"}
 
-        valid = []
+        # Single pass: the cheap payment method check runs before the amount
+        # checks, and the best price is tracked as we go
+        best, best_price = None, -1.0
         for ad in ads:
-            mn = float(ad["adv"]["minSingleTransAmount"])
-            mx = float(ad["adv"]["dynamicMaxSingleTransAmount"])
-            avl = float(ad["adv"]["surplusAmount"])
-            if mn <= usdt_amount <= mx and avl >= usdt_amount:
-                valid.append(ad)
-
-        if not valid:
-            return {"currency": currency, "success": False, "error": f"No merchant accepts {usdt_amount} USDT"}
-
-        # Filter by allowed payment methods
-        valid = [
-            ad for ad in valid
-            if any(
-                m["tradeMethodName"] in ALLOWED_PAYMENT_METHODS
-                for m in ad["adv"]["tradeMethods"]
-            )
-        ]
-
-        if not valid:
-            return {"currency": currency, "success": False, "error": "No ads with allowed payment methods"}
-
-        best = max(valid, key=lambda x: float(x["adv"]["price"]))
-        price = float(best["adv"]["price"])
+            adv = ad.adv
+            if ALLOWED_PAYMENT_METHODS.isdisjoint(m.tradeMethodName for m in adv.tradeMethods):
+                continue
+            if not (adv.minSingleTransAmount <= usdt_amount <= adv.dynamicMaxSingleTransAmount
+                    and adv.surplusAmount >= usdt_amount):
+                continue
+            if adv.price > best_price:
+                best, best_price = ad, adv.price
+
+        if best is None:
+            return {"currency": currency, "success": False, "error": f"No merchant with allowed payment methods accepts {usdt_amount} USDT"}
+
+        adv = best.adv
         pays = [
-            m["tradeMethodName"] for m in best["adv"]["tradeMethods"]
-            if m["tradeMethodName"] in ALLOWED_PAYMENT_METHODS
+            m.tradeMethodName for m in adv.tradeMethods
+            if m.tradeMethodName in ALLOWED_PAYMENT_METHODS
         ]
 
         return {
             "currency": currency,
-            "price": price,
-            "total_usdt": usdt_amount * price,
-            "merchant": best["advertiser"]["nickName"],
+            "price": adv.price,
+            "total_usdt": usdt_amount * adv.price,
+            "merchant": best.advertiser.nickName,
             "payment_methods": pays,
-            "min": float(best["adv"]["minSingleTransAmount"]),
-            "max": float(best["adv"]["dynamicMaxSingleTransAmount"]),
-            "available": float(best["adv"]["surplusAmount"]),
-            "completion_pct": round(float(best["advertiser"].get("monthFinishRate", 0)) * 100, 2),
-            "monthly_orders": int(best["advertiser"].get("monthOrderCount", 0)),
+            "min": adv.minSingleTransAmount,
+            "max": adv.dynamicMaxSingleTransAmount,
+            "available": adv.surplusAmount,
+            "completion_pct": round(best.advertiser.monthFinishRate * 100, 2),
+            "monthly_orders": best.advertiser.monthOrderCount,
             "success": True,
         }
     except Exception as e:
         return {"currency": currency, "success": False, "error": str(e)}
 
+# Short-lived cache in front of the P2P search. Overlapping /fetch calls
+# share one request per (currency, amount): the first caller fetches while
+# the others wait on the same lock and then read its result.
+P2P_CACHE_TTL = 20  # seconds
+_p2p_cache = {}  # (currency, usdt_amount) -> (fetched_at, result)
+_p2p_locks = {}
+
+def _p2p_cache_get(key):
+    hit = _p2p_cache.get(key)
+    if hit and time.monotonic() - hit[0] < P2P_CACHE_TTL:
+        return dict(hit[1])
+    return None
+
+async def cached_p2p(currency, usdt_amount):
+    key = (currency, usdt_amount)
+    result = _p2p_cache_get(key)
+    if result is not None:
+        return result
+    async with _p2p_locks.setdefault(key, asyncio.Lock()):
+        result = _p2p_cache_get(key)
+        if result is not None:
+            return result
+        result = await get_p2p_buy_price_for_currency(currency, usdt_amount)
+        if result["success"]:
+            _p2p_cache[key] = (time.monotonic(), result)
+        return dict(result)
+
+# Query every supported currency concurrently
+async def fetch_all_async():
+    # GBP itself is skipped: offers are ranked by their GBP equivalent, so a
+    # GBP quote never makes the table. Other currencies check the standard amount.
+    return await asyncio.gather(*(
+        cached_p2p(currency, 100)
+        for currency in HSBC_SUPPORTED_CURRENCIES if currency != "GBP"
+    ))
+
 # Format results
-def fmt_results(results, gbp_amount, usdt_price):
+def fmt_results(results, gbp_amount, usdt_price, usdt_to_egp, now=None):
     if not results:
         return "❌ No results found."
 
-    ts = datetime.datetime.now().strftime("%d %b %Y  %H:%M:%S")
+    ts = f"{now or datetime.datetime.now():%d %b %Y  %H:%M:%S}"
     best = results[0]
 
-    # Calculate EGP equivalent for the GBP amount
-    gbp_to_egp = get_exchange_rate("GBP", "EGP")
-    if gbp_to_egp:
-        gbp_egp = gbp_amount * gbp_to_egp
-    else:
-        gbp_egp = "N/A"
-
     # Calculate how much USDT we'd get for the GBP amount
     if usdt_price:
         usdt_amount = gbp_amount / usdt_price
-        usdt_egp = usdt_amount * get_exchange_rate("USDT", "EGP") if get_exchange_rate("USDT", "EGP") else "N/A"
+        usdt_price_str = f"{usdt_price:.6f}"
+        usdt_amount_str = f"{usdt_amount:.2f}"
+        usdt_egp = f"{usdt_amount * usdt_to_egp:.2f}" if usdt_to_egp else "N/A"
     else:
-        usdt_amount = "N/A"
-        usdt_egp = "N/A"
+        usdt_price_str = usdt_amount_str = usdt_egp = "N/A"
+
+    # Nicknames are user-chosen; markup in one would get the whole message
+    # rejected. Inside a code span only a backtick can break out.
+    best_merchant = best["merchant"].replace("`", "'")
 
     lines = [
         f"*💰 Best Buy Rates for {gbp_amount} GBP*",
         f"🕐 `{ts}`",
-        f"💵 Current USDT/GBP rate: `{usdt_price:.6f}` USDT/GBP (from previous fetch)",
+        f"💵 Current USDT/GBP rate: `{usdt_price_str}` USDT/GBP (from previous fetch)",
         "",
         "🏆 *BEST OFFER*",
         f"  Currency : `{best['currency']}`",
         f"  Price    : `{best['price']:.6f}` USDT/{best['currency']}",
-        f"  For {gbp_amount} GBP you'd get: `{usdt_amount:.2f}` USDT",
+        f"  For {gbp_amount} GBP you'd get: `{usdt_amount_str}` USDT",
         f"  EGP equiv : `{usdt_egp}` EGP",
-        f"  Merchant : `{best['merchant']}` ({best['completion_pct']}%)",
+        f"  Merchant : `{best_merchant}` ({best['completion_pct']}%)",
         f"  Payment  : {', '.join(best['payment_methods'][:3])}",
         f"  Limits   : {best['min']:.0f} - {best['max']:.0f} {best['currency']}",
         "",
@@ -180,14 +321,14 @@ def fmt_results(results, gbp_amount, usdt_price):
 
     for i, r in enumerate(results[:5]):
         usdt_for_gbp = gbp_amount / r["price"]
-        usdt_egp = usdt_for_gbp * get_exchange_rate("USDT", "EGP") if get_exchange_rate("USDT", "EGP") else "N/A"
-        medal = ["🥇", "🥈", "🥉"][i] if i < 3 else f"{i+1}."
+        usdt_egp = f"{usdt_for_gbp * usdt_to_egp:.2f}" if usdt_to_egp else "N/A"
+        medal = MEDALS[i] if i < 3 else f"{i+1}."
         lines.append(
             f"{medal} `{r['currency']}` "
             f"price `{r['price']:.6f}` "
             f"= `{usdt_for_gbp:.2f}` USDT "
             f"= `{usdt_egp}` EGP "
-            f"| {r['merchant']}"
+            f"| {escape_markdown(r['merchant'])}"
         )
 
     return "\n".join(lines)
@@ -216,6 +357,7 @@ async def cmd_setgbp(update: Update, context: ContextTypes.DEFAULT_TYPE):
         state["gbp_amount"] = amount
         state["last_results"] = []
         state["last_usdt_price"] = None
+        await save_state()
         await update.message.reply_text(f"✅ Set to sell `{amount}` GBP", parse_mode="Markdown")
     except ValueError:
         await update.message.reply_text("❌ Please enter a valid amount (e.g., `/setgbp 1000`)", parse_mode="Markdown")
@@ -225,46 +367,43 @@ async def cmd_fetch(update: Update, context: ContextTypes.DEFAULT_TYPE):
         await update.message.reply_text("❌ Please set your GBP amount first with `/setgbp X`", parse_mode="Markdown")
         return
 
-    # First get the current USDT/GBP rate
-    try:
-        gbp_to_usdt = get_exchange_rate("GBP", "USDT")
-        if gbp_to_usdt:
-            state["last_usdt_price"] = 1 / gbp_to_usdt
-        else:
-            state["last_usdt_price"] = None
-    except:
+    # One batch: the GBP-based FX table and all P2P searches. That single
+    # table gives the USDT/GBP rate, every currency->GBP conversion and,
+    # crossed through GBP, the USDT->EGP rate
+    gbp_rates, p2p_results = await asyncio.gather(
+        get_rates_table("GBP"),
+        fetch_all_async(),
+    )
+    gbp_rates = gbp_rates or {}
+    gbp_to_usdt = gbp_rates.get("USDT")
+    if gbp_to_usdt:
+        state["last_usdt_price"] = 1 / gbp_to_usdt
+        usdt_to_egp = gbp_rates["EGP"] / gbp_to_usdt if gbp_rates.get("EGP") else None
+    else:
         state["last_usdt_price"] = None
+        usdt_to_egp = None
 
-    # Calculate how much USDT we'd get for our GBP amount
-    usdt_for_gbp = state["gbp_amount"] / state["last_usdt_price"] if state["last_usdt_price"] else None
-
-    # Now get the best buy prices for all supported currencies
     results = []
-    for currency in HSBC_SUPPORTED_CURRENCIES:
-        # Calculate how much USDT we need to buy to get equivalent value
-        if currency == "GBP":
-            usdt_needed = usdt_for_gbp if usdt_for_gbp else 100
-        else:
-            # For other currencies, we'll just check the standard amount
-            usdt_needed = 100
-
-        result = get_p2p_buy_price_for_currency(currency, usdt_needed)
+    for result in p2p_results:
+        currency = result["currency"]
         if result["success"]:
-            # Convert to GBP equivalent
-            if currency != "GBP":
-                price_in_gbp = result["price"] * get_exchange_rate(currency, "GBP")
-                if price_in_gbp:
-                    result["price_in_gbp"] = price_in_gbp
-                    results.append(result)
-
-    # Sort by price (best first)
-    results.sort(key=lambda x: x.get("price_in_gbp", 0), reverse=True)
+            # Convert to GBP equivalent; the table holds units of currency per GBP
+            if gbp_rates.get(currency):
+                result["price_in_gbp"] = result["price"] / gbp_rates[currency]
+                results.append(result)
+
+    # Keep the five best by price (best first); only those are shown
+    results = heapq.nlargest(5, results, key=lambda x: x.get("price_in_gbp", 0))
+    state["last_results"] = results
+    now = datetime.datetime.now()
+    state["last_fetch"] = now
+    await save_state()
 
     # Format and send results
     if not results:
         msg = "❌ No results found for any currency"
     else:
-        msg = fmt_results(results, state["gbp_amount"], state["last_usdt_price"])
+        msg = fmt_results(results, state["gbp_amount"], state["last_usdt_price"], usdt_to_egp, now)
 
     await update.message.reply_text(msg, parse_mode="Markdown")
 
@@ -279,7 +418,7 @@ async def cmd_status(update: Update, context: ContextTypes.DEFAULT_TYPE):
         f"  GBP amount to sell : `{gbp_amount}` GBP\n"
         f"  Current USDT/GBP rate : `{usdt_price:.6f}` USDT/GBP\n"
         f"  Last fetch          : `{last_s}`\n"
-        f"  Allowed payment    : `{', '.join(ALLOWED_PAYMENT_METHODS)}`"
+        f"  Allowed payment    : `{ALLOWED_PAYMENT_STR}`"
     )
     await update.message.reply_text(msg, parse_mode="Markdown")
 
@@ -292,6 +431,7 @@ async def handle_text(update: Update, context: ContextTypes.DEFAULT_TYPE):
             state["gbp_amount"] = amount
             state["last_results"] = []
             state["last_usdt_price"] = None
+            await save_state()
             await update.message.reply_text(f"✅ Updated to sell `{amount}` GBP", parse_mode="Markdown")
         else:
             await update.message.reply_text("❌ Please enter a positive number", parse_mode="Markdown")
@@ -299,7 +439,13 @@ async def handle_text(update: Update, context: ContextTypes.DEFAULT_TYPE):
         await update.message.reply_text("❌ Please enter a valid number", parse_mode="Markdown")
 
 def main():
-    app = Application.builder().token(BOT_TOKEN).build()
+    app = (
+        Application.builder()
+        .token(BOT_TOKEN)
+        .post_init(open_http)
+        .post_shutdown(close_http)
+        .build()
+    )
 
     app.add_handler(CommandHandler("start", cmd_start))
     app.add_handler(CommandHandler("setgbp", cmd_setgbp))
@@ -309,8 +455,17 @@ def main():
     # Handle any text message as potential GBP amount update
     app.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, handle_text))
 
-    logger.info("Bot is running...")
-    app.run_polling()
+    if WEBHOOK_URL:
+        logger.info("Bot is running (webhook on port %d)...", PORT)
+        app.run_webhook(
+            listen="0.0.0.0",
+            port=PORT,
+            url_path=BOT_TOKEN,
+            webhook_url=f"{WEBHOOK_URL}/{BOT_TOKEN}",
+        )
+    else:
+        logger.info("Bot is running...")
+        app.run_polling()
 
 if __name__ == "__main__":
     main()
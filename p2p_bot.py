@@ -1,137 +1,374 @@
 import os
-import requests
+import asyncio
+import httpx
 import datetime
+import heapq
 import logging
+import msgspec
+import random
+import time
+from operator import itemgetter
+from collections import OrderedDict
 from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup
+from telegram.helpers import escape_markdown
 from telegram.ext import (
     Application, CommandHandler, CallbackQueryHandler,
-    ContextTypes, MessageHandler, filters
+    ContextTypes, MessageHandler, PicklePersistence, filters
 )
 
 # ── Config ────────────────────────────────────────────────────────────────────
 BOT_TOKEN = os.environ.get("BOT_TOKEN", "")
-CHAT_ID   = int(os.environ.get("CHAT_ID", "0"))
-if not BOT_TOKEN or CHAT_ID == 0:
-    raise ValueError("BOT_TOKEN and CHAT_ID must be set in environment variables")
+if not BOT_TOKEN:
+    raise ValueError("BOT_TOKEN must be set in environment variables")
+PERSISTENCE_FILE = os.environ.get("PERSISTENCE_FILE", "p2p_bot_data.pickle")
+# Public base URL (e.g. https://mybot.example.com); when set, Telegram pushes
+# updates to us via webhook instead of the bot long-polling getUpdates
+WEBHOOK_URL = os.environ.get("WEBHOOK_URL", "").rstrip("/")
+PORT        = int(os.environ.get("PORT", "8443"))
 
 # ── Constants ─────────────────────────────────────────────────────────────────
 ASSETS     = ["USDT", "BTC", "BNB"]
 FIAT_LIST  = ["GBP", "EUR", "USD", "AUD", "ZAR", "PLN", "CAD", "NZD",
               "CHF", "SEK", "HKD", "AED", "CZK", "NOK", "DKK", "SGD",
               "JPY", "CNY", "EGP"]
-PAY_METHODS = {"Bank Transfer", "Faster Payment", "Instant Transfer"}
+PAY_METHODS: frozenset[str] = frozenset({"Bank Transfer", "Faster Payment", "Instant Transfer"})
+# Fiat searches in flight across all chats. One fetch goes out in a single
+# wave; fetches for different settings that overlap queue behind each other
+CONCURRENCY_LIMIT = len(FIAT_LIST)
+P2P_ROWS = (5, 20)   # ads per search: short page first, longer one on a miss
 
 # ── State ─────────────────────────────────────────────────────────────────────
-state = {
+# Settings are kept per chat in context.chat_data; these are the defaults
+DEFAULT_STATE = {
     "amount_gbp": 500.0,
     "asset":      "USDT",   # USDT | BTC | BNB
     "trade_type": "SELL",   # SELL | BUY
     "last_fetch": None,
     "alert_threshold": None,
-    "auto_job": None,
+    "auto_broadcast": False,   # auto-fetch posts every result, not just alerts
 }
 
-logging.basicConfig(format="%(asctime)s - %(levelname)s - %(message)s", level=logging.INFO)
+
+def chat_state(context: ContextTypes.DEFAULT_TYPE) -> dict:
+    """Settings for the chat behind this update or job, seeded with defaults."""
+    data = context.chat_data
+    for key, value in DEFAULT_STATE.items():
+        data.setdefault(key, value)
+    return data
+
+
+def auto_job_name(chat_id: int) -> str:
+    return f"auto_fetch_{chat_id}"
+
 logger = logging.getLogger(__name__)
 
+# ── HTTP client ───────────────────────────────────────────────────────────────
+# One async client for Binance and FX calls, opened on the bot's event loop.
+# Connections are kept alive, so only the first call to each host pays for
+# the TCP+TLS handshake. Idle ones are kept for KEEPALIVE_EXPIRY, which is
+# longer than the shortest auto-fetch interval, so scheduled fetches reuse them
+# too (httpx's default of 5 s would drop them between ticks).
+HTTP: httpx.AsyncClient | None = None
+USER_AGENT = "Mozilla/5.0 (Windows NT 10.0; Win64; x64)"
+KEEPALIVE_EXPIRY = 120   # seconds
+BINANCE_HEADERS = {
+    "Origin":  "https://p2p.binance.com",
+    "Referer": "https://p2p.binance.com/",
+}
+
+
+async def open_http(app: Application):
+    global HTTP
+    HTTP = httpx.AsyncClient(
+        transport=httpx.AsyncHTTPTransport(
+            http2=True,   # all fiat searches share one multiplexed connection
+            # no transport retries: post_p2p owns retrying Binance searches,
+            # and FX failures fall back to the cached table
+            limits=httpx.Limits(max_connections=32, max_keepalive_connections=32,
+                                keepalive_expiry=KEEPALIVE_EXPIRY),
+        ),
+        headers={"User-Agent": USER_AGENT, "Accept": "application/json"},
+        timeout=httpx.Timeout(15, connect=3),
+    )
+    # Warm the GBP cross-rate table so the first /fetch doesn't wait on it
+    await get_all_rates_from_gbp()
+
+
+async def close_http(app: Application):
+    if HTTP is not None:
+        await HTTP.aclose()
+
 # ── Binance P2P ───────────────────────────────────────────────────────────────
-def fetch_p2p(fiat: str, asset: str, trade_type: str, amount: float) -> dict:
-    url = "https://p2p.binance.com/bapi/c2c/v2/friendly/c2c/adv/search"
+P2P_URL        = "https://p2p.binance.com/bapi/c2c/v2/friendly/c2c/adv/search"
+P2P_RETRIES    = 2
+RETRY_STATUSES = frozenset({429, 500, 502, 503, 504})
+# Search fields that never change; fetch_p2p merges in the per-call ones
+# (rows is set per attempt from P2P_ROWS)
+P2P_PAYLOAD_TEMPLATE = {
+    "page": 1,
+    "countries": [],
+    "proMerchantAds": False,
+    "shieldMerchantAds": False,
+    "filterType": "all",
+    "periods": [],
+    "additionalKycVerifyFilter": 0,
+    "publisherType": None,
+    "payTypes": [],
+    "classifies": ["mass", "profession", "fiat_trade"],
+}
+
+
+# Only the fields we read are declared; the rest of each ad is skipped while
+# decoding. Binance sends numbers as strings, and lax mode turns them into
+# floats/ints during the decode, so no float() calls are needed afterwards.
+class TradeMethod(msgspec.Struct):
+    tradeMethodName: str | None = None
+
+
+class Adv(msgspec.Struct):
+    price: float
+    minSingleTransAmount: float
+    dynamicMaxSingleTransAmount: float
+    surplusAmount: float
+    tradeMethods: list[TradeMethod] = []
+
+
+class Advertiser(msgspec.Struct):
+    nickName: str
+    monthFinishRate: float = 0.0
+    monthOrderCount: int = 0
+
+
+class Ad(msgspec.Struct):
+    adv: Adv
+    advertiser: Advertiser
+
+
+class SearchResponse(msgspec.Struct):
+    data: list[Ad] | None = None
+
+
+P2P_DECODER = msgspec.json.Decoder(SearchResponse, strict=False)
+
+
+# exchangerate-api response; everything besides the rates table is skipped
+class RatesResponse(msgspec.Struct):
+    rates: dict[str, float]
+
+
+FX_DECODER = msgspec.json.Decoder(RatesResponse)
+
+
+async def post_p2p(payload: dict) -> httpx.Response:
+    """POST a search, retrying timeouts, dropped connections and 429/5xx.
+
+    Backoff is exponential with a little jitter so the concurrent fiat
+    requests that failed together don't all retry in lockstep.
+    """
+    for attempt in range(P2P_RETRIES + 1):
+        try:
+            r = await HTTP.post(P2P_URL, json=payload, headers=BINANCE_HEADERS)
+            if r.status_code not in RETRY_STATUSES or attempt == P2P_RETRIES:
+                return r
+        except (httpx.TimeoutException, httpx.NetworkError):
+            if attempt == P2P_RETRIES:
+                raise
+        await asyncio.sleep(0.2 * 2 ** attempt + random.random() * 0.1)
+
+
+async def fetch_p2p(fiat: str, asset: str, trade_type: str, amount: float) -> dict:
     payload = {
-        "fiat": fiat,
-        "page": 1,
-        "rows": 20,
-        "tradeType": trade_type,
-        "asset": asset,
-        "countries": [],
-        "proMerchantAds": False,
-        "shieldMerchantAds": False,
-        "filterType": "all",
-        "periods": [],
-        "additionalKycVerifyFilter": 0,
-        "publisherType": None,
-        "payTypes": [],
-        "classifies": ["mass", "profession", "fiat_trade"],
+        **P2P_PAYLOAD_TEMPLATE,
+        "fiat":        fiat,
+        "asset":       asset,
+        "tradeType":   trade_type,
         "transAmount": str(amount),
     }
-    headers = {
-        "Content-Type": "application/json",
-        "Origin": "https://p2p.binance.com",
-        "Referer": "https://p2p.binance.com/",
-        "User-Agent": "Mozilla/5.0 (Windows NT 10.0; Win64; x64)",
-    }
-    try:
-        r = requests.post(url, json=payload, headers=headers, timeout=15)
-        if r.status_code != 200:
-            return {"success": False, "error": f"HTTP {r.status_code}"}
-        ads = r.json().get("data") or []
-        if not ads:
-            return {"success": False, "error": "No ads found"}
-
-        # filter by amount range
-        valid = [
-            a for a in ads
-            if float(a["adv"]["minSingleTransAmount"]) <= amount
-            <= float(a["adv"]["dynamicMaxSingleTransAmount"])
-            and float(a["adv"]["surplusAmount"]) >= amount
-        ]
-        if not valid:
-            return {"success": False, "error": "No ads match your amount"}
-
-        # filter by payment method
-        valid = [
-            a for a in valid
-            if any(m["tradeMethodName"] in PAY_METHODS
-                   for m in a["adv"]["tradeMethods"])
-        ]
-        if not valid:
-            return {"success": False, "error": "No ads with allowed payment methods"}
-
-        # SELL → highest price wins  |  BUY → lowest price wins
-        if trade_type == "SELL":
-            best = max(valid, key=lambda x: float(x["adv"]["price"]))
-        else:
-            best = min(valid, key=lambda x: float(x["adv"]["price"]))
 
-        price   = float(best["adv"]["price"])
-        methods = [m["tradeMethodName"] for m in best["adv"]["tradeMethods"]
-                   if m["tradeMethodName"] in PAY_METHODS]
+    def usable(ad: Ad) -> bool:
+        adv = ad.adv
+        return (adv.minSingleTransAmount <= amount <= adv.dynamicMaxSingleTransAmount
+                and adv.surplusAmount >= amount
+                and not PAY_METHODS.isdisjoint(m.tradeMethodName for m in adv.tradeMethods))
+
+    # SELL → highest price wins  |  BUY → lowest price wins
+    pick = max if trade_type == "SELL" else min
+    try:
+        # Ads come back best price first, so a short page usually holds the
+        # winner; only ask for the longer page when none of those qualify
+        for rows in P2P_ROWS:
+            payload["rows"] = rows
+            r = await post_p2p(payload)
+            if r.status_code != 200:
+                return {"success": False, "error": f"HTTP {r.status_code}"}
+            ads = P2P_DECODER.decode(r.content).data or []
+            if not ads:
+                return {"success": False, "error": "No ads found"}
+
+            best = pick(filter(usable, ads), key=lambda ad: ad.adv.price, default=None)
+            if best is not None or len(ads) < rows:
+                break   # found one, or there are no more ads to page in
+        if best is None:
+            return {"success": False, "error": "No ads match your amount and payment methods"}
+
+        adv, advertiser = best.adv, best.advertiser
+        methods = sorted(PAY_METHODS.intersection(m.tradeMethodName for m in adv.tradeMethods))
 
         return {
             "success":      True,
             "fiat":         fiat,
             "asset":        asset,
             "trade_type":   trade_type,
-            "price":        price,
-            "merchant":     best["advertiser"]["nickName"],
-            "completion":   round(float(best["advertiser"].get("monthFinishRate", 0)) * 100, 1),
-            "orders":       int(best["advertiser"].get("monthOrderCount", 0)),
+            "price":        adv.price,
+            "merchant":     advertiser.nickName,
+            "completion":   round(advertiser.monthFinishRate * 100, 1),
+            "orders":       advertiser.monthOrderCount,
             "methods":      methods,
-            "min":          float(best["adv"]["minSingleTransAmount"]),
-            "max":          float(best["adv"]["dynamicMaxSingleTransAmount"]),
-            "available":    float(best["adv"]["surplusAmount"]),
+            "min":          adv.minSingleTransAmount,
+            "max":          adv.dynamicMaxSingleTransAmount,
+            "available":    adv.surplusAmount,
         }
     except Exception as e:
         return {"success": False, "error": str(e)}
 
 
-def get_egp_rate(fiat: str) -> float | None:
-    """Get how many EGP = 1 unit of fiat via exchangerate-api."""
+FX_TTL       = 3600     # seconds a table counts as fresh; reference rates move daily
+FX_MAX_STALE = 86400    # older than this, wait for a refresh instead of serving it
+_fx_cache: tuple[dict[str, float], float] | None = None   # (rates, fetched_at)
+_fx_lock = asyncio.Lock()
+_fx_refresh: asyncio.Task | None = None
+
+
+async def refresh_rates_from_gbp() -> dict[str, float]:
+    global _fx_cache
     try:
-        r = requests.get(
-            f"https://api.exchangerate-api.com/v4/latest/{fiat}", timeout=5
+        r = await HTTP.get(
+            "https://api.exchangerate-api.com/v4/latest/GBP", timeout=5
         )
-        return r.json()["rates"].get("EGP")
+        rates = FX_DECODER.decode(r.content).rates
     except Exception:
-        return None
+        return {}
+    _fx_cache = (rates, time.monotonic())
+    return rates
+
+
+async def get_all_rates_from_gbp() -> dict[str, float]:
+    """Get how many units of every currency = 1 GBP via exchangerate-api (cached).
+
+    One response holds every cross rate run_fetch needs, so a fetch makes at
+    most one FX request instead of one or two per fiat. Once a table goes
+    stale it is still served while a single background refresh runs, so
+    fetches don't wait on exchangerate-api.
+    """
+    global _fx_refresh
+    if _fx_cache:
+        rates, fetched_at = _fx_cache
+        age = time.monotonic() - fetched_at
+        if age < FX_TTL:
+            return rates
+        if age < FX_MAX_STALE:
+            if _fx_refresh is None or _fx_refresh.done():
+                _fx_refresh = asyncio.create_task(refresh_rates_from_gbp())
+            return rates
+    # Nothing usable cached: concurrent callers share one request
+    async with _fx_lock:
+        if _fx_cache and time.monotonic() - _fx_cache[1] < FX_TTL:
+            return _fx_cache[0]
+        return await refresh_rates_from_gbp()
 
 
 # ── Core fetch logic ──────────────────────────────────────────────────────────
-def run_fetch(amount_gbp: float, asset: str, trade_type: str) -> str:
-    ts = datetime.datetime.now().strftime("%d %b %Y  %H:%M:%S")
+async def fetch_fiat(fiat: str, asset: str, trade_type: str,
+                     amount_gbp: float, per_gbp: float | None,
+                     egp_gbp: float | None) -> dict:
+    """Best ad for one fiat; per_gbp / egp_gbp are fiat / EGP units per 1 GBP."""
+    # Convert GBP → fiat to know the transaction amount
+    amount_fiat = amount_gbp * per_gbp if per_gbp else amount_gbp  # fallback
+    # EGP per 1 unit of this fiat, reused for the price conversion below
+    egp_per_fiat = egp_gbp / per_gbp if per_gbp and egp_gbp else None
+
+    res = await fetch_p2p(fiat, asset, trade_type, amount_fiat)
+    if not res["success"]:
+        return res
+
+    res["egp_price"]  = res["price"] * egp_per_fiat if egp_per_fiat else None
+    res["amount_fiat"] = amount_fiat
+    return res
+
+
+# Shared by every fetch, so it caps fiat searches across chats, not per call
+_fetch_sem = asyncio.Semaphore(CONCURRENCY_LIMIT)
+# Fetches currently running, keyed by (amount_gbp, asset, trade_type)
+_inflight: dict[tuple, asyncio.Task] = {}
+
+
+async def fetch_results(amount_gbp: float, asset: str,
+                        trade_type: str) -> tuple[list[dict], float | None]:
+    """Every fiat's best ad (unsorted), plus the EGP/GBP rate used to convert them.
+
+    Callers asking for the same thing while a fetch is running (a button
+    press during an auto-fetch, two chats on the defaults) share its result
+    instead of starting another fan-out.
+    """
+    key = (amount_gbp, asset, trade_type)
+    task = _inflight.get(key)
+    if task is None:
+        task = asyncio.create_task(_fetch_results(amount_gbp, asset, trade_type))
+        _inflight[key] = task
+        task.add_done_callback(lambda _: _inflight.pop(key, None))
+    # shield: one caller being cancelled mustn't cancel the others' fetch
+    return await asyncio.shield(task)
+
+
+async def _fetch_results(amount_gbp: float, asset: str,
+                         trade_type: str) -> tuple[list[dict], float | None]:
+    rates = await get_all_rates_from_gbp()
+    egp_gbp = rates.get("EGP")
+
+    async def limited(fiat: str) -> dict:
+        async with _fetch_sem:
+            return await fetch_fiat(fiat, asset, trade_type, amount_gbp,
+                                    rates.get(fiat), egp_gbp)
+
+    fetched = await asyncio.gather(*(limited(f) for f in FIAT_LIST), return_exceptions=True)
+    results = [res for res in fetched if isinstance(res, dict) and res["success"]]
+
+    return results, egp_gbp
+
+
+MEDALS = ("🥇", "🥈", "🥉")
+# One block per fiat in the ranking; fields come from fetch_fiat's result dict.
+# Nicknames are user-chosen, so they're escaped: a stray _ or * would make
+# Telegram reject the whole Markdown message
+RESULT_ROW = (
+    "{medal} *{fiat}*  •  `{price:,.6f}` {fiat}/{asset}  ≈  {egp_str}\n"
+    "     👤 {merchant_md} ({completion}%  {orders} orders)\n"
+    "     💳 {methods_str}\n"
+    "     📊 Limits: {min:,.0f} – {max:,.0f} {fiat}\n"
+)
+
+
+def top_results(results: list[dict], trade_type: str, n: int = 10) -> list[dict]:
+    """SELL → highest EGP price first  |  BUY → lowest EGP price first.
+
+    Offers with no EGP price can't be ranked, so they only fill spare rows.
+    """
+    priced = [r for r in results if r["egp_price"] is not None]
+    pick = heapq.nlargest if trade_type == "SELL" else heapq.nsmallest
+    top = pick(n, priced, key=itemgetter("egp_price"))
+    return top + [r for r in results if r["egp_price"] is None][:n - len(top)]
+
+
+def format_results(results: list[dict], amount_gbp: float, asset: str,
+                   trade_type: str, egp_gbp: float | None,
+                   now: datetime.datetime) -> str:
+    if not results:
+        return "❌ No results found for any currency."
+    results = top_results(results, trade_type)
+
+    ts = f"{now:%d %b %Y  %H:%M:%S}"
     emoji_asset = {"USDT": "💵", "BTC": "₿", "BNB": "🔶"}.get(asset, "💰")
     emoji_trade = "📤 SELL" if trade_type == "SELL" else "📥 BUY"
-    egp_gbp = get_egp_rate("GBP")
 
     lines = [
         f"{emoji_asset} *{asset} — {emoji_trade} — HSBC UK Currencies*",
@@ -141,76 +378,53 @@ def run_fetch(amount_gbp: float, asset: str, trade_type: str) -> str:
         "",
     ]
 
-    results = []
-    for fiat in FIAT_LIST:
-        # For non-GBP fiats convert GBP → fiat to know the transaction amount
-        if fiat == "GBP":
-            amount_fiat = amount_gbp
-        else:
-            rate = get_egp_rate(fiat)    # EGP per 1 fiat
-            egp_per_gbp = egp_gbp        # EGP per 1 GBP
-            if rate and egp_per_gbp:
-                amount_fiat = amount_gbp * egp_per_gbp / rate
-            else:
-                amount_fiat = amount_gbp  # fallback
-
-        res = fetch_p2p(fiat, asset, trade_type, amount_fiat)
-        if not res["success"]:
-            continue
-
-        # EGP equivalent of the fiat price
-        egp_rate = get_egp_rate(fiat)
-        egp_price = res["price"] * egp_rate if egp_rate else None
-
-        res["egp_price"]  = egp_price
-        res["amount_fiat"] = amount_fiat
-        results.append(res)
-
-    if not results:
-        return "❌ No results found for any currency."
-
-    # Sort: SELL → highest EGP price first  |  BUY → lowest EGP price first
-    results.sort(
-        key=lambda x: x["egp_price"] or 0,
-        reverse=(trade_type == "SELL")
+    lines.extend(
+        RESULT_ROW.format(
+            **r,
+            medal=MEDALS[i] if i < 3 else f"{i+1}.",
+            egp_str=f"`{r['egp_price']:,.2f}` EGP" if r["egp_price"] else "N/A",
+            methods_str=" | ".join(r["methods"]),
+            merchant_md=escape_markdown(r["merchant"]),
+        )
+        for i, r in enumerate(results)
     )
+    return "\n".join(lines)
 
-    medals = ["🥇", "🥈", "🥉"]
-    for i, r in enumerate(results[:10]):
-        medal = medals[i] if i < 3 else f"{i+1}."
-        egp_str = f"`{r['egp_price']:,.2f}` EGP" if r["egp_price"] else "N/A"
-        lines.append(
-            f"{medal} *{r['fiat']}*  •  "
-            f"`{r['price']:,.6f}` {r['fiat']}/{r['asset']}  "
-            f"≈  {egp_str}\n"
-            f"     👤 {r['merchant']} ({r['completion']}%  {r['orders']} orders)\n"
-            f"     💳 {' | '.join(r['methods'])}\n"
-            f"     📊 Limits: {r['min']:,.0f} – {r['max']:,.0f} {r['fiat']}\n"
-        )
 
-    state["last_fetch"] = datetime.datetime.now()
-    return "\n".join(lines)
+async def run_fetch(state: dict) -> str:
+    """Fetch and format with the chat's settings, stamping last_fetch."""
+    now = datetime.datetime.now()
+    amount_gbp, asset, trade_type = state["amount_gbp"], state["asset"], state["trade_type"]
+    results, egp_gbp = await fetch_results(amount_gbp, asset, trade_type)
+    state["last_fetch"] = now
+    return format_results(results, amount_gbp, asset, trade_type, egp_gbp, now)
 
 
 # ── Keyboards ─────────────────────────────────────────────────────────────────
-def main_keyboard():
-    return InlineKeyboardMarkup([
-        [
-            InlineKeyboardButton("📤 SELL", callback_data="set_trade_SELL"),
-            InlineKeyboardButton("📥 BUY",  callback_data="set_trade_BUY"),
-        ],
-        [
-            InlineKeyboardButton("💵 USDT", callback_data="set_asset_USDT"),
-            InlineKeyboardButton("₿ BTC",   callback_data="set_asset_BTC"),
-            InlineKeyboardButton("🔶 BNB",  callback_data="set_asset_BNB"),
-        ],
-        [
-            InlineKeyboardButton("🔍 Fetch Now", callback_data="do_fetch"),
-        ],
-    ])
+# Built once; Telegram objects are immutable, so the markup is safe to reuse
+MAIN_KEYBOARD = InlineKeyboardMarkup([
+    [
+        InlineKeyboardButton("📤 SELL", callback_data="set_trade_SELL"),
+        InlineKeyboardButton("📥 BUY",  callback_data="set_trade_BUY"),
+    ],
+    [
+        InlineKeyboardButton("💵 USDT", callback_data="set_asset_USDT"),
+        InlineKeyboardButton("₿ BTC",   callback_data="set_asset_BTC"),
+        InlineKeyboardButton("🔶 BNB",  callback_data="set_asset_BNB"),
+    ],
+    [
+        InlineKeyboardButton("🔍 Fetch Now", callback_data="do_fetch"),
+    ],
+])
 
 
 # ── Handlers ──────────────────────────────────────────────────────────────────
+# Chats with a /fetch or Fetch Now still running; repeats are turned away
+# rather than queueing another fetch and another reply behind it
+_fetching_chats: set[int] = set()
+FETCH_BUSY_TEXT = "⏳ A fetch is already running, results are on the way."
+
+
 async def cmd_start(update: Update, context: ContextTypes.DEFAULT_TYPE):
     msg = (
         "👋 *Binance P2P Bot*\n\n"
@@ -224,13 +438,15 @@ async def cmd_start(update: Update, context: ContextTypes.DEFAULT_TYPE):
         "/bnb           — switch to BNB\n"
         "/autostart `120` — auto-fetch every N seconds\n"
         "/autostop      — stop auto-fetch\n"
+        "/autobroadcast `on|off` — post every auto-fetch, not just alerts\n"
         "/setalert `650000` — alert when EGP price exceeds value\n"
         "/status        — current settings\n"
     )
-    await update.message.reply_text(msg, parse_mode="Markdown", reply_markup=main_keyboard())
+    await update.message.reply_text(msg, parse_mode="Markdown", reply_markup=MAIN_KEYBOARD)
 
 
 async def cmd_setgbp(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    state = chat_state(context)
     try:
         amount = float(context.args[0])
         if amount <= 0:
@@ -244,40 +460,56 @@ async def cmd_setgbp(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
 
 async def cmd_sell(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    state = chat_state(context)
     state["trade_type"] = "SELL"
     await update.message.reply_text("✅ Mode set to *SELL*", parse_mode="Markdown")
 
 
 async def cmd_buy(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    state = chat_state(context)
     state["trade_type"] = "BUY"
     await update.message.reply_text("✅ Mode set to *BUY*", parse_mode="Markdown")
 
 
 async def cmd_usdt(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    state = chat_state(context)
     state["asset"] = "USDT"
     await update.message.reply_text("✅ Asset set to *USDT*", parse_mode="Markdown")
 
 
 async def cmd_btc(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    state = chat_state(context)
     state["asset"] = "BTC"
     await update.message.reply_text("✅ Asset set to *BTC*", parse_mode="Markdown")
 
 
 async def cmd_bnb(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    state = chat_state(context)
     state["asset"] = "BNB"
     await update.message.reply_text("✅ Asset set to *BNB*", parse_mode="Markdown")
 
 
 async def cmd_fetch(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    msg = await update.message.reply_text("⏳ Fetching best prices...", parse_mode="Markdown")
-    result = run_fetch(state["amount_gbp"], state["asset"], state["trade_type"])
-    await msg.edit_text(result, parse_mode="Markdown")
+    state = chat_state(context)
+    chat_id = update.effective_chat.id
+    if chat_id in _fetching_chats:
+        await update.message.reply_text(FETCH_BUSY_TEXT)
+        return
+    _fetching_chats.add(chat_id)
+    try:
+        msg = await update.message.reply_text("⏳ Fetching best prices...", parse_mode="Markdown")
+        result = await run_fetch(state)
+        await msg.edit_text(result, parse_mode="Markdown")
+    finally:
+        _fetching_chats.discard(chat_id)
 
 
 async def cmd_setalert(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    state = chat_state(context)
     try:
         threshold = float(context.args[0])
         state["alert_threshold"] = threshold
+        state["alerted_keys"] = OrderedDict()
         await update.message.reply_text(
             f"🔔 Alert set for `{threshold:,.2f}` EGP", parse_mode="Markdown"
         )
@@ -286,8 +518,11 @@ async def cmd_setalert(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
 
 async def cmd_status(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    last_s = state["last_fetch"].strftime("%H:%M:%S") if state["last_fetch"] else "Never"
-    auto   = "Running ✅" if state["auto_job"] else "Stopped ❌"
+    state = chat_state(context)
+    last_s = f"{state['last_fetch']:%H:%M:%S}" if state["last_fetch"] else "Never"
+    auto   = ("Running ✅" if context.job_queue.get_jobs_by_name(auto_job_name(update.effective_chat.id))
+              else "Stopped ❌")
+    broadcast = "On" if state["auto_broadcast"] else "Off (alerts only — /autobroadcast on)"
     msg = (
         f"⚙️ *Status*\n\n"
         f"  Amount     : `{state['amount_gbp']:,.2f}` GBP\n"
@@ -295,6 +530,7 @@ async def cmd_status(update: Update, context: ContextTypes.DEFAULT_TYPE):
         f"  Trade      : `{state['trade_type']}`\n"
         f"  Last fetch : `{last_s}`\n"
         f"  Auto-fetch : {auto}\n"
+        f"  Broadcast  : {broadcast}\n"
         f"  Alert      : `{state['alert_threshold']:,.2f}` EGP"
         if state["alert_threshold"] else
         f"⚙️ *Status*\n\n"
@@ -303,38 +539,75 @@ async def cmd_status(update: Update, context: ContextTypes.DEFAULT_TYPE):
         f"  Trade      : `{state['trade_type']}`\n"
         f"  Last fetch : `{last_s}`\n"
         f"  Auto-fetch : {auto}\n"
+        f"  Broadcast  : {broadcast}\n"
         f"  Alert      : Not set"
     )
     await update.message.reply_text(msg, parse_mode="Markdown")
 
 
 # ── Auto-fetch job ─────────────────────────────────────────────────────────────
+ALERT_REPEAT_AFTER = 3600   # seconds before the same offer may alert again
+ALERT_KEYS_MAX     = 1024   # cap on remembered offers per chat
+
+
+def should_alert(state: dict, key: tuple) -> bool:
+    """Remember `key` and report whether it is new within the repeat window.
+
+    Keys are kept oldest-first in an OrderedDict used as an LRU, so expired
+    and overflowing entries pop off the front in O(1) and memory stays
+    bounded however long the auto-fetch runs. It never awaits, so jobs and
+    handlers on the one event loop can't interleave inside it; no lock needed.
+    """
+    seen = state.get("alerted_keys")
+    if not isinstance(seen, OrderedDict):   # chats persisted with a plain dict
+        seen = state["alerted_keys"] = OrderedDict(seen or {})
+    now = time.time()
+    last = seen.get(key)
+    seen[key] = now
+    seen.move_to_end(key)
+    while seen:
+        if now - next(iter(seen.values())) < ALERT_REPEAT_AFTER and len(seen) <= ALERT_KEYS_MAX:
+            break
+        seen.popitem(last=False)
+    return last is None or now - last >= ALERT_REPEAT_AFTER
+
+
 async def auto_fetch_job(context: ContextTypes.DEFAULT_TYPE):
-    result = run_fetch(state["amount_gbp"], state["asset"], state["trade_type"])
+    state = chat_state(context)
     threshold = state["alert_threshold"]
+    if not threshold and not state["auto_broadcast"]:
+        return   # nothing would be sent, so don't hit Binance at all
+
+    now = datetime.datetime.now()
+    amount_gbp, asset, trade_type = state["amount_gbp"], state["asset"], state["trade_type"]
+    results, egp_gbp = await fetch_results(amount_gbp, asset, trade_type)
+    state["last_fetch"] = now
 
     if threshold:
-        # Check if any result exceeds threshold
-        for line in result.split("\n"):
-            if "EGP" in line:
-                try:
-                    egp_val = float(
-                        line.split("`")[3].replace(",", "")
-                    )
-                    if (state["trade_type"] == "SELL" and egp_val >= threshold) or \
-                       (state["trade_type"] == "BUY"  and egp_val <= threshold):
-                        await context.bot.send_message(
-                            chat_id=CHAT_ID,
-                            text=f"🚨 *ALERT TRIGGERED!*\n\n{result}",
-                            parse_mode="Markdown"
-                        )
-                        return
-                except Exception:
-                    pass
-    else:
+        # SELL alerts at or above the threshold, BUY at or below it
+        if trade_type == "SELL":
+            hits = [r for r in results if r["egp_price"] is not None and r["egp_price"] >= threshold]
+        else:
+            hits = [r for r in results if r["egp_price"] is not None and r["egp_price"] <= threshold]
+        if not hits:
+            return   # the usual quiet-market tick: nothing to remember or send
+
+        # Every qualifying offer is remembered; the alert fires only if one is new
+        fresh = False
+        for r in hits:
+            key = (asset, trade_type, r["fiat"], round(r["egp_price"], 4))
+            fresh = should_alert(state, key) or fresh
+        if fresh:
+            text = format_results(results, amount_gbp, asset, trade_type, egp_gbp, now)
+            await context.bot.send_message(
+                chat_id=context.job.chat_id,
+                text=f"🚨 *ALERT TRIGGERED!*\n\n{text}",
+                parse_mode="Markdown"
+            )
+    elif state["auto_broadcast"]:
         await context.bot.send_message(
-            chat_id=CHAT_ID,
-            text=result,
+            chat_id=context.job.chat_id,
+            text=format_results(results, amount_gbp, asset, trade_type, egp_gbp, now),
             parse_mode="Markdown"
         )
 
@@ -347,28 +620,46 @@ async def cmd_autostart(update: Update, context: ContextTypes.DEFAULT_TYPE):
             return
 
         # Remove existing job if any
-        if state["auto_job"]:
-            state["auto_job"].schedule_removal()
-            state["auto_job"] = None
+        chat_id = update.effective_chat.id
+        for job in context.job_queue.get_jobs_by_name(auto_job_name(chat_id)):
+            job.schedule_removal()
 
-        job = context.job_queue.run_repeating(
+        context.job_queue.run_repeating(
             auto_fetch_job,
             interval=interval,
             first=5,
-            chat_id=CHAT_ID,
-        )
-        state["auto_job"] = job
-        await update.message.reply_text(
-            f"▶️ Auto-fetch every `{interval}` seconds started.", parse_mode="Markdown"
+            chat_id=chat_id,
+            name=auto_job_name(chat_id),
         )
+        msg = f"▶️ Auto-fetch every `{interval}` seconds started."
+        state = chat_state(context)
+        if not state["alert_threshold"] and not state["auto_broadcast"]:
+            # auto_fetch_job skips every tick in this case, so say so up front
+            msg += ("\n⚠️ Nothing will be posted yet (alerts only): "
+                    "set /setalert or /autobroadcast on")
+        await update.message.reply_text(msg, parse_mode="Markdown")
     except (IndexError, ValueError):
         await update.message.reply_text("❌ Usage: `/autostart 120`", parse_mode="Markdown")
 
 
+async def cmd_autobroadcast(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    state = chat_state(context)
+    arg = context.args[0].lower() if context.args else ""
+    if arg not in ("on", "off"):
+        await update.message.reply_text("❌ Usage: `/autobroadcast on|off`", parse_mode="Markdown")
+        return
+    state["auto_broadcast"] = arg == "on"
+    await update.message.reply_text(
+        "📢 Auto-fetch will post every result." if state["auto_broadcast"]
+        else "🔕 Auto-fetch will only post alerts."
+    )
+
+
 async def cmd_autostop(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    if state["auto_job"]:
-        state["auto_job"].schedule_removal()
-        state["auto_job"] = None
+    jobs = context.job_queue.get_jobs_by_name(auto_job_name(update.effective_chat.id))
+    if jobs:
+        for job in jobs:
+            job.schedule_removal()
         await update.message.reply_text("⏹️ Auto-fetch stopped.")
     else:
         await update.message.reply_text("ℹ️ Auto-fetch is not running.")
@@ -379,10 +670,11 @@ async def button_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
     query = update.callback_query
     await query.answer()
     data = query.data
+    state = chat_state(context)
 
     if data.startswith("set_trade_"):
         state["trade_type"] = data.split("_")[2]
-        await query.edit_message_reply_markup(reply_markup=main_keyboard())
+        await query.edit_message_reply_markup(reply_markup=MAIN_KEYBOARD)
         await context.bot.send_message(
             chat_id=query.message.chat_id,
             text=f"✅ Mode set to *{state['trade_type']}*",
@@ -391,7 +683,7 @@ async def button_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
     elif data.startswith("set_asset_"):
         state["asset"] = data.split("_")[2]
-        await query.edit_message_reply_markup(reply_markup=main_keyboard())
+        await query.edit_message_reply_markup(reply_markup=MAIN_KEYBOARD)
         await context.bot.send_message(
             chat_id=query.message.chat_id,
             text=f"✅ Asset set to *{state['asset']}*",
@@ -399,20 +691,29 @@ async def button_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
         )
 
     elif data == "do_fetch":
-        await context.bot.send_message(
-            chat_id=query.message.chat_id,
-            text="⏳ Fetching best prices..."
-        )
-        result = run_fetch(state["amount_gbp"], state["asset"], state["trade_type"])
-        await context.bot.send_message(
-            chat_id=query.message.chat_id,
-            text=result,
-            parse_mode="Markdown"
-        )
+        chat_id = query.message.chat_id
+        if chat_id in _fetching_chats:
+            await context.bot.send_message(chat_id=chat_id, text=FETCH_BUSY_TEXT)
+            return
+        _fetching_chats.add(chat_id)
+        try:
+            await context.bot.send_message(
+                chat_id=chat_id,
+                text="⏳ Fetching best prices..."
+            )
+            result = await run_fetch(state)
+            await context.bot.send_message(
+                chat_id=chat_id,
+                text=result,
+                parse_mode="Markdown"
+            )
+        finally:
+            _fetching_chats.discard(chat_id)
 
 
 # ── Handle plain number messages ──────────────────────────────────────────────
 async def handle_text(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    state = chat_state(context)
     try:
         amount = float(update.message.text.replace(",", ""))
         if amount > 0:
@@ -426,7 +727,26 @@ async def handle_text(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
 # ── Main ──────────────────────────────────────────────────────────────────────
 def main():
-    app = Application.builder().token(BOT_TOKEN).build()
+    # %(created) skips the per-record strftime that %(asctime) costs; httpx
+    # logs every request at INFO, which is dozens of lines per fetch
+    logging.basicConfig(format="%(created).3f - %(levelname)s - %(message)s", level=logging.INFO)
+    logging.getLogger("httpx").setLevel(logging.WARNING)
+
+    app = (
+        Application.builder()
+        .token(BOT_TOKEN)
+        .persistence(PicklePersistence(filepath=PERSISTENCE_FILE))
+        .concurrent_updates(True)   # a running fetch must not hold up other updates
+        # Bot API calls and the getUpdates long-poll get separate pools, so a
+        # burst of replies/alerts can't starve polling (or the other way round)
+        .connection_pool_size(32)
+        .pool_timeout(10)
+        .get_updates_connection_pool_size(4)
+        .get_updates_pool_timeout(20)
+        .post_init(open_http)
+        .post_shutdown(close_http)
+        .build()
+    )
 
     app.add_handler(CommandHandler("start",      cmd_start))
     app.add_handler(CommandHandler("setgbp",     cmd_setgbp))
@@ -439,12 +759,23 @@ def main():
     app.add_handler(CommandHandler("setalert",   cmd_setalert))
     app.add_handler(CommandHandler("autostart",  cmd_autostart))
     app.add_handler(CommandHandler("autostop",   cmd_autostop))
+    app.add_handler(CommandHandler("autobroadcast", cmd_autobroadcast))
     app.add_handler(CommandHandler("status",     cmd_status))
     app.add_handler(CallbackQueryHandler(button_callback))
     app.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, handle_text))
 
-    logger.info("Bot started.")
-    app.run_polling()
+    if WEBHOOK_URL:
+        logger.info("Bot started (webhook on port %d).", PORT)
+        app.run_webhook(
+            listen="0.0.0.0",
+            port=PORT,
+            url_path=BOT_TOKEN,
+            webhook_url=f"{WEBHOOK_URL}/{BOT_TOKEN}",
+            max_connections=40,
+        )
+    else:
+        logger.info("Bot started.")
+        app.run_polling()
 
 
 if __name__ == "__main__":